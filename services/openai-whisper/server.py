@@ -1,116 +1,304 @@
 import asyncio
+import hashlib
 import websockets
-import json
 import logging
 import os
-import tempfile
+import signal
+import struct
 import time
+import uuid
+from collections import OrderedDict
 from typing import Optional, Dict, Any
 import soundfile as sf
+import httpx
 import numpy as np
-from openai import OpenAI
+import orjson
+from openai import AsyncOpenAI
 import redis.asyncio as redis
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+_BYTES_PER_SECOND = 16000 * 4  # 16 kHz mono float32
+
+# RIFF header for the bot's 16 kHz mono float32 PCM; only the two size fields change per chunk
+_WAV_HEADER_TEMPLATE = struct.pack(
+    '<4sI4s4sIHHIIHH4sI',
+    b'RIFF', 0, b'WAVE', b'fmt ', 16, 3, 1, 16000, 64000, 4, 32, b'data', 0
+)
+_UINT32 = struct.Struct('<I')
+
+def _wav_from_pcm(pcm: bytes) -> bytes:
+    """Prefix raw PCM with a WAV header without going through the wave module"""
+    header = bytearray(_WAV_HEADER_TEMPLATE)
+    _UINT32.pack_into(header, 4, 36 + len(pcm))
+    _UINT32.pack_into(header, 40, len(pcm))
+    return b''.join((header, pcm))
+
 class OpenAIWhisperServer:
     def __init__(self):
-        self.openai_client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
         self.redis_client = None
+        self.redis_pool = None
         self.model = os.getenv('OPENAI_WHISPER_MODEL', 'whisper-1')
         self.max_retries = int(os.getenv('OPENAI_MAX_RETRIES', '3'))
         self.timeout = int(os.getenv('OPENAI_TIMEOUT', '30'))
+        # The SDK sends its own timeout with every request, so both must get the same object
+        http_timeout = httpx.Timeout(self.timeout, connect=5.0)
+        # One pooled HTTP/2 connection is shared by all uploads instead of a TLS handshake per chunk
+        self.http_client = httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(max_keepalive_connections=32, max_connections=64, keepalive_expiry=300),
+            timeout=http_timeout
+        )
+        self.openai_client = AsyncOpenAI(
+            api_key=os.getenv('OPENAI_API_KEY'),
+            max_retries=self.max_retries,
+            timeout=http_timeout,
+            http_client=self.http_client
+        )
+        self.stream_name = os.getenv('REDIS_STREAM_NAME', 'transcription_segments').encode()
+        self.redis_batch_size = int(os.getenv('REDIS_BATCH_SIZE', '32'))
+        self.redis_batch_interval = int(os.getenv('REDIS_BATCH_INTERVAL_MS', '200')) / 1000
+        self.redis_queue = asyncio.Queue()
+        self.flusher_task = None
+        self.pending_tasks = set()
+        self.transcription_semaphore = asyncio.Semaphore(int(os.getenv('OPENAI_CONCURRENCY', '4')))
+        self.max_pending_chunks = int(os.getenv('MAX_PENDING_CHUNKS', '16'))
+        self.chunk_seconds = float(os.getenv('CHUNK_SECONDS', '5'))
+        self.max_buffer_bytes = int(_BYTES_PER_SECOND * self.chunk_seconds * 4)
+        # Float32 RMS below which a chunk is treated as silence (~200 on the int16 scale)
+        self.silence_rms_threshold = float(os.getenv('SILENCE_RMS_THRESHOLD', '0.006'))
+        # Recent transcripts keyed by a digest of the audio, so repeated chunks skip the API
+        self.transcript_cache = OrderedDict()
+        self.transcript_cache_size = int(os.getenv('TRANSCRIPT_CACHE_SIZE', '256'))
         
     async def init_redis(self):
         redis_host = os.getenv('REDIS_HOST', 'redis')
         redis_port = int(os.getenv('REDIS_PORT', '6379'))
         redis_db = int(os.getenv('REDIS_DB', '0'))
         
-        self.redis_client = redis.Redis(
+        # One pool shared by every client connection
+        self.redis_pool = redis.ConnectionPool(
             host=redis_host, 
             port=redis_port, 
             db=redis_db,
-            decode_responses=True
+            max_connections=int(os.getenv('REDIS_POOL_SIZE', '64')),
+            # Replies are never read back, so skip decoding them
+            decode_responses=False
         )
+        self.redis_client = redis.Redis(connection_pool=self.redis_pool)
+
+    async def _pipeline_flusher(self):
+        """Publish queued stream entries to Redis in pipelined batches"""
+        loop = asyncio.get_running_loop()
+        while True:
+            stream_data = await self.redis_queue.get()
+            if stream_data is None:
+                return
+            batch = [stream_data]
+            deadline = loop.time() + self.redis_batch_interval
+            try:
+                # Keep collecting until the batch is full or the interval elapses
+                while len(batch) < self.redis_batch_size:
+                    remaining = deadline - loop.time()
+                    if remaining <= 0:
+                        break
+                    try:
+                        stream_data = await asyncio.wait_for(self.redis_queue.get(), timeout=remaining)
+                    except asyncio.TimeoutError:
+                        break
+                    if stream_data is None:
+                        # Shutdown sentinel: publish what was collected and stop
+                        await self._publish_batch(batch)
+                        return
+                    batch.append(stream_data)
+            except asyncio.CancelledError:
+                # These entries are already off the queue, so publish them before stopping
+                await self._publish_batch(batch)
+                raise
+
+            await self._publish_batch(batch)
+
+    async def _publish_batch(self, batch):
+        """XADD a batch of stream entries in a single round-trip"""
+        try:
+            async with self.redis_client.pipeline(transaction=False) as pipe:
+                for stream_data in batch:
+                    pipe.xadd(self.stream_name, stream_data)
+                await pipe.execute()
+        except Exception as e:
+            logger.error(f"Failed to publish {len(batch)} segment(s) to Redis: {e}")
+
+    def _spawn(self, coro):
+        """Run a coroutine in the background, keeping a reference until it finishes"""
+        task = asyncio.create_task(coro)
+        self.pending_tasks.add(task)
+        task.add_done_callback(self._on_task_done)
+        return task
+
+    def _on_task_done(self, task):
+        self.pending_tasks.discard(task)
+        if not task.cancelled() and task.exception():
+            logger.error(f"Background task failed: {task.exception()}")
+
+    async def shutdown(self):
+        """Stop the flusher and publish anything still queued"""
+        if self.flusher_task:
+            # Everything queued ahead of the sentinel is published before the flusher returns
+            self.redis_queue.put_nowait(None)
+        await asyncio.gather(*self.pending_tasks, return_exceptions=True)
+        
+        batch = []
+        while not self.redis_queue.empty():
+            batch.append(self.redis_queue.get_nowait())
+        if batch:
+            await self._publish_batch(batch)
+        await self.redis_client.aclose()
+        await self.redis_pool.disconnect()
+        await self.openai_client.close()
         
     async def transcribe_audio(self, audio_data: bytes, language: str = None) -> str:
         """Transcribe audio using OpenAI Whisper API"""
+        key = (hashlib.blake2b(audio_data, digest_size=16).digest(), language)
+        cached = self.transcript_cache.get(key)
+        if cached is not None:
+            self.transcript_cache.move_to_end(key)
+            return cached
+        
         try:
-            # Save audio to temporary file
-            with tempfile.NamedTemporaryFile(suffix='.wav', delete=False) as temp_file:
-                temp_file.write(audio_data)
-                temp_file_path = temp_file.name
-            
-            # Transcribe with OpenAI
-            with open(temp_file_path, 'rb') as audio_file:
-                transcript = self.openai_client.audio.transcriptions.create(
-                    model=self.model,
-                    file=audio_file,
-                    language=language,
-                    response_format="text"
-                )
-            
-            # Clean up temp file
-            os.unlink(temp_file_path)
+            # Upload straight from memory
+            transcript = await self.openai_client.audio.transcriptions.create(
+                model=self.model,
+                file=("audio.wav", audio_data, "audio/wav"),
+                language=language,
+                response_format="text"
+            )
             
+            self.transcript_cache[key] = transcript
+            if len(self.transcript_cache) > self.transcript_cache_size:
+                self.transcript_cache.popitem(last=False)
             return transcript
             
         except Exception as e:
             logger.error(f"Transcription error: {e}")
             return ""
     
+    def is_silent(self, audio_data: bytes) -> bool:
+        """Check whether a chunk of float32 PCM is quiet enough to skip transcription"""
+        pcm = np.frombuffer(audio_data, dtype=np.float32, count=len(audio_data) // 4)
+        if pcm.size == 0:
+            return True
+        return float(np.sqrt(np.mean(np.square(pcm)))) < self.silence_rms_threshold
+
+    def segment_template(self, client_id: str) -> Dict[str, Any]:
+        """Build the per-connection stream fields that stay fixed across segments"""
+        return {
+            'client_id': client_id,
+            'language': 'auto',  # OpenAI auto-detects
+            'confidence': 1.0    # OpenAI doesn't provide confidence
+        }
+
+    async def process_chunk(self, websocket, template: Dict[str, Any], audio_data: bytes, previous=None):
+        """Transcribe one audio chunk and publish the result after the previous chunk's"""
+        client_id = template['client_id']
+        if self.is_silent(audio_data):
+            logger.debug(f"Skipping silent chunk from client {client_id}")
+            transcript = ""
+        else:
+            async with self.transcription_semaphore:
+                transcript = await self.transcribe_audio(_wav_from_pcm(audio_data))
+        
+        # Only the OpenAI calls overlap; results go out in the order the chunks were captured
+        if previous is not None:
+            await asyncio.wait([previous])
+        
+        if transcript.strip():
+            timestamp = time.time()
+            # Send to Redis stream (maintaining compatibility)
+            stream_data = {**template, 'text': transcript, 'timestamp': timestamp}
+            
+            self.redis_queue.put_nowait(stream_data)
+            
+            # Send back to client
+            response = {
+                'text': transcript,
+                'timestamp': timestamp
+            }
+            try:
+                await websocket.send(orjson.dumps(response).decode())
+            except websockets.exceptions.ConnectionClosed:
+                logger.debug(f"Client {client_id} gone before its transcript was sent")
+
     async def handle_client(self, websocket):
         """Handle WebSocket client connection"""
-        client_id = f"client_{int(time.time())}"
+        # Generated once per connection; replaced by the bot's session uid from its config message
+        client_id = str(uuid.uuid4())
+        template = self.segment_template(client_id)
         logger.info(f"Client {client_id} connected")
+        in_flight = set()
+        last_task = None
+        buf = bytearray()
+        loop = asyncio.get_running_loop()
+        last_send = loop.time()
         
         try:
-            async for message in websocket:
+            while True:
+                # Wake up at the chunk deadline even if the client goes quiet
+                remaining = self.chunk_seconds - (loop.time() - last_send)
+                try:
+                    message = await asyncio.wait_for(websocket.recv(), timeout=max(0, remaining))
+                except asyncio.TimeoutError:
+                    message = None
+                
                 if isinstance(message, bytes):
-                    # Audio data received
-                    transcript = await self.transcribe_audio(message)
-                    
-                    if transcript.strip():
-                        # Send to Redis stream (maintaining compatibility)
-                        stream_data = {
-                            'text': transcript,
-                            'timestamp': time.time(),
-                            'client_id': client_id,
-                            'language': 'auto',  # OpenAI auto-detects
-                            'confidence': 1.0    # OpenAI doesn't provide confidence
-                        }
-                        
-                        await self.redis_client.xadd(
-                            'transcription_segments',
-                            stream_data
-                        )
-                        
-                        # Send back to client
-                        response = {
-                            'text': transcript,
-                            'timestamp': time.time()
-                        }
-                        await websocket.send(json.dumps(response))
+                    # Audio data received; accumulate until a full chunk is due
+                    buf.extend(message)
+                    if len(buf) > self.max_buffer_bytes:
+                        # Keep only the newest audio if the client outpaces transcription
+                        del buf[:len(buf) - self.max_buffer_bytes]
+                        logger.warning(f"Client {client_id} audio buffer full, dropping oldest audio")
                         
                 elif isinstance(message, str):
                     # Handle JSON messages (configuration, etc.)
                     try:
-                        data = json.loads(message)
+                        data = orjson.loads(message)
                         # Handle configuration messages if needed
                         logger.info(f"Received config: {data}")
-                    except json.JSONDecodeError:
+                        if isinstance(data, dict) and data.get('uid'):
+                            client_id = data['uid']
+                            template = self.segment_template(client_id)
+                    except orjson.JSONDecodeError:
                         logger.warning(f"Invalid JSON received: {message}")
+                
+                now = loop.time()
+                if now - last_send < self.chunk_seconds:
+                    continue
+                last_send = now
+                if not buf:
+                    continue
+                
+                # Stop reading while too many chunks are still being transcribed
+                if len(in_flight) >= self.max_pending_chunks:
+                    await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+                last_task = self._spawn(self.process_chunk(websocket, template, bytes(buf), last_task))
+                buf.clear()
+                in_flight.add(last_task)
+                last_task.add_done_callback(in_flight.discard)
                         
         except websockets.exceptions.ConnectionClosed:
             logger.info(f"Client {client_id} disconnected")
         except Exception as e:
             logger.error(f"Error handling client {client_id}: {e}")
+        finally:
+            # Transcribe whatever audio arrived after the last full chunk
+            if buf:
+                self._spawn(self.process_chunk(websocket, template, bytes(buf), last_task))
         
 
     async def start_server(self):
         """Start the WebSocket server"""
         await self.init_redis()
+        self.flusher_task = self._spawn(self._pipeline_flusher())
         
         logger.info("Starting OpenAI Whisper WebSocket server on port 9090")
         
@@ -132,11 +320,23 @@ class OpenAIWhisperServer:
         
         logger.info("Health check server started on port 9091")
         
-        # Keep servers running
-        await asyncio.gather(
-            main_server.wait_closed(),
-            health_server.wait_closed()
-        )
+        # Keep servers running until asked to stop; as PID 1 in the container SIGTERM needs a handler
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, stop.set)
+        
+        try:
+            await stop.wait()
+            logger.info("Shutting down, closing client connections")
+            main_server.close()
+            health_server.close()
+            await asyncio.gather(
+                main_server.wait_closed(),
+                health_server.wait_closed()
+            )
+        finally:
+            await self.shutdown()
 
     async def health_handler(self, websocket, path):
         """Health check handler"""